@@ -1,8 +1,259 @@
-from typing import MutableSequence, Optional, Tuple
+import collections
+import functools
+import random
+from typing import Callable, List, MutableSequence, Optional, Sequence, Tuple
 
 import deap.algorithms
 import deap.base
 import deap.tools
+import numba
+import numpy
+
+
+def population_matrix(individuals: Sequence) -> numpy.ndarray:
+    """Get the genotypes of the given individuals as a single contiguous matrix, one row per individual.
+
+    The individuals are joined in one copy into a single block of memory, instead of being wrapped and stacked one by one. A matrix is returned as it is.
+
+    :param individuals: A non empty sequence of individuals of the same length and type, or a matrix with an individual in each row
+    :type individuals: Sequence
+    :return: A matrix with the genotype of the i-th individual in the i-th row
+    :rtype: numpy.ndarray
+    """
+    if isinstance(individuals, numpy.ndarray):
+        return individuals
+
+    first = numpy.asarray(individuals[0])
+    return numpy.frombuffer(bytearray().join(individuals), dtype=first.dtype).reshape(len(individuals), first.size)
+
+
+def random_generator() -> numpy.random.Generator:
+    """Get a NumPy random generator seeded from the :mod:`random` module.
+
+    The DEAP operators draw from :mod:`random`, so seeding it alone reproduces the runs that also draw from this generator.
+
+    :return: A new random generator
+    :rtype: numpy.random.Generator
+    """
+    return numpy.random.default_rng(random.getrandbits(64))
+
+
+def population_from_matrix(container: type, matrix: numpy.ndarray) -> List:
+    """Create one individual from each row of the given matrix.
+
+    :param container: An individual class based on :class:`array.array`
+    :type container: type
+    :param matrix: A matrix with the genotype of an individual in each row
+    :type matrix: numpy.ndarray
+    :return: The individuals, in the order of the rows
+    :rtype: List
+    """
+    return [container(row.tobytes()) for row in matrix.astype(container.typecode)]
+
+
+def create_lines_count(
+        queens_amount: int,
+        count_columns: bool = True,
+        individuals_amount: Optional[int] = None
+) -> numpy.ndarray:
+    """Create a buffer to count the queens in each line where two queens attack each other: columns, diagonals and anti-diagonals.
+
+    The counters are 16 bits wide, which is enough for any board whose columns fit in a byte, so the whole buffer takes a few cache lines.
+
+    :param queens_amount: The amount of queens
+    :type queens_amount: int
+    :param count_columns: Whether the buffer has room for the columns or only for the diagonals and anti-diagonals
+    :type count_columns: bool
+    :param individuals_amount: If given, the buffer has one row for each of this amount of individuals
+    :type individuals_amount: Optional[int]
+    :return: The uninitialized buffer
+    :rtype: numpy.ndarray
+    """
+    lines_amount = (5 if count_columns else 4)*queens_amount - 2
+    shape = lines_amount if individuals_amount is None else (individuals_amount, lines_amount)
+    return numpy.empty(shape, dtype=numpy.uint16)
+
+
+@numba.njit(inline='always')
+def count_lines_violations(columns, lines_count, queens_amount, count_columns):
+    """Count the pairs of queens placed in the same line, with the given buffer created by :func:`create_lines_count`.
+
+    It is inlined in the kernels of :func:`get_violations_kernel` and :func:`get_violations_batch_kernel`, where the amount of queens and *count_columns* are constants.
+
+    :param columns: The column of the queen of each row
+    :type columns: numpy.ndarray
+    :param lines_count: The buffer where the queens in each line are counted
+    :type lines_count: numpy.ndarray
+    :param queens_amount: The amount of queens
+    :type queens_amount: int
+    :param count_columns: Whether two queens in the same column are a violation
+    :type count_columns: bool
+    :return: The amount of violations
+    :rtype: int
+    """
+    # the lines are the columns, if counted, then the diagonals, identified by the sum of their row and column,
+    # and then the anti-diagonals, identified by their difference shifted to be non negative
+    diagonals_offset = queens_amount if count_columns else 0
+    anti_diagonals_offset = diagonals_offset + 2*queens_amount - 1 + queens_amount - 1
+
+    lines_count[:] = 0
+    for i in range(queens_amount):
+        # widened to a signed integer, as the columns may be unsigned
+        c = numpy.int64(columns[i])
+        if count_columns:
+            lines_count[c] += 1
+        lines_count[diagonals_offset + i + c] += 1
+        lines_count[anti_diagonals_offset + i - c] += 1
+
+    # every pair of queens sharing a line is a violation
+    violations_amount = 0
+    for count in lines_count:
+        violations_amount += numpy.int64(count)*(count-1)//2
+
+    return violations_amount
+
+
+@functools.lru_cache(maxsize=None)
+def get_violations_kernel(queens_amount: int, columns_type: str, count_columns: bool) -> Callable:
+    """Get the kernel that counts the pairs of queens placed in the same line, compiled for the given amount of queens.
+
+    The amount of queens is a compile time constant of the kernel, so the bounds of the loops and the offsets of the lines are known by the compiler. The kernel is compiled the first time it is requested for each combination of arguments, in each process, and the compiled code is cached on disk to be reused by later processes.
+
+    The kernel receives the column of the queen of each row and a buffer created by :func:`create_lines_count` with the same *count_columns*, and returns the amount of violations.
+
+    :param queens_amount: The amount of queens
+    :type queens_amount: int
+    :param columns_type: The Numba type of the columns, like ``'uint8'`` or ``'int64'``
+    :type columns_type: str
+    :param count_columns: Whether two queens in the same column are a violation. It is not needed when the columns are a permutation.
+    :type count_columns: bool
+    :return: The kernel for an individual
+    :rtype: Callable
+    """
+    def count_violations(columns, lines_count):
+        return count_lines_violations(columns, lines_count, queens_amount, count_columns)
+
+    # the names of the compiled symbols come from the qualified name, so each combination gets its own one. Otherwise
+    # the cached code of several combinations, compiled by different processes, may clash when loaded together
+    count_violations.__qualname__ += f'_{queens_amount}_{columns_type}_{count_columns:d}'
+
+    return numba.njit(f'int64({columns_type}[::1], uint16[::1])', cache=True)(count_violations)
+
+
+@functools.lru_cache(maxsize=None)
+def get_violations_batch_kernel(queens_amount: int, columns_type: str, count_columns: bool) -> Callable:
+    """Get the kernel that counts the violations of several individuals in parallel, compiled for the given amount of queens.
+
+    It is compiled apart from the one of :func:`get_violations_kernel`, so the processes that only evaluate individuals one by one do not compile it. It is not cached on disk, as the cached code of parallel kernels refers to generated symbols whose names may repeat between processes.
+
+    The kernel receives a matrix with one row of columns per individual and a buffer created by :func:`create_lines_count` with as many rows, and returns the amount of violations of each row.
+
+    :param queens_amount: The amount of queens
+    :type queens_amount: int
+    :param columns_type: The Numba type of the columns, like ``'uint8'`` or ``'int64'``
+    :type columns_type: str
+    :param count_columns: Whether two queens in the same column are a violation
+    :type count_columns: bool
+    :return: The kernel for several individuals
+    :rtype: Callable
+    """
+    @numba.njit(f'int64[::1]({columns_type}[:, ::1], uint16[:, ::1])', parallel=True)
+    def count_violations_batch(matrix, lines_count):
+        violations_amounts = numpy.empty(matrix.shape[0], dtype=numpy.int64)
+        for k in numba.prange(matrix.shape[0]):
+            violations_amounts[k] = count_lines_violations(matrix[k], lines_count[k], queens_amount, count_columns)
+
+        return violations_amounts
+
+    return count_violations_batch
+
+
+def batch_map(
+        evaluate: Callable,
+        individuals: Sequence,
+        batch_evaluate: Callable[[Sequence], List[Tuple]]
+) -> List[Tuple]:
+    """Replacement of ``toolbox.map`` that evaluates all the given individuals in a single call.
+
+    DEAP evaluates individuals with ``toolbox.map(toolbox.evaluate, individuals)``. Registering this function as ``map`` with *batch_evaluate* bound delegates the evaluation of the whole list to *batch_evaluate*, so the given *evaluate* function is ignored.
+
+    :param evaluate: The evaluation function given by the algorithm. It is ignored.
+    :type evaluate: Callable
+    :param individuals: The individuals to evaluate
+    :type individuals: Sequence
+    :param batch_evaluate: A function that receives a sequence of individuals and returns the list of their fitnesses
+    :type batch_evaluate: Callable[[Sequence], List[Tuple]]
+    :return: The fitnesses of the individuals, in the same order
+    :rtype: List[Tuple]
+    """
+    if not individuals:
+        return []
+    return batch_evaluate(individuals)
+
+
+def evaluate_invalid(
+        individuals: Sequence,
+        toolbox: deap.base.Toolbox,
+        cache: collections.OrderedDict,
+        cache_size: int
+) -> int:
+    """Evaluate the individuals with an invalid fitness, reusing the fitness of already evaluated genotypes.
+
+    The genotypes are looked up by their bytes in *cache*, which is updated inplace as a least recently used cache. Repeated genotypes are evaluated only once.
+
+    :param individuals: The individuals to evaluate if their fitness is invalid
+    :type individuals: Sequence
+    :param toolbox: A :class:`~deap.base.Toolbox` with the ``map`` and ``evaluate`` aliases
+    :type toolbox: deap.base.Toolbox
+    :param cache: The fitness values of the known genotypes
+    :type cache: collections.OrderedDict
+    :param cache_size: The maximum amount of genotypes to keep in *cache*
+    :type cache_size: int
+    :return: The amount of individuals that were actually evaluated
+    :rtype: int
+    """
+    pending = collections.defaultdict(list)
+    for ind in individuals:
+        if ind.fitness.valid:
+            continue
+        key = bytes(ind)
+        if key in cache:
+            cache.move_to_end(key)
+            ind.fitness.values = cache[key]
+        else:
+            pending[key].append(ind)
+
+    fitnesses = toolbox.map(toolbox.evaluate, [inds[0] for inds in pending.values()])
+    for (key, inds), fit in zip(pending.items(), fitnesses):
+        cache[key] = fit
+        for ind in inds:
+            ind.fitness.values = fit
+
+    while len(cache) > cache_size:
+        cache.popitem(last=False)
+
+    return len(pending)
+
+
+class FitnessStatistics(deap.tools.Statistics):
+    """A :class:`~deap.tools.Statistics` object over the first fitness value of the individuals.
+
+    The values are gathered once per compilation into a single array of floats, so the registered functions, like ``numpy.min`` and ``numpy.mean``, receive an array instead of a tuple of one element tuples to convert.
+    """
+
+    def __init__(self):
+        super().__init__(lambda ind: ind.fitness.values[0])
+
+    def compile(self, data: Sequence) -> dict:
+        """Apply the registered functions to the fitness values of the given individuals.
+
+        :param data: The individuals
+        :type data: Sequence
+        :return: The result of each registered function by its name
+        :rtype: dict
+        """
+        values = numpy.fromiter(map(self.key, data), dtype=float, count=len(data))
+        return {name: func(values) for name, func in self.functions.items()}
 
 
 def eaSimpleWithElitism(
@@ -13,13 +264,18 @@ def eaSimpleWithElitism(
         ngen: int,
         stats: Optional[deap.tools.Statistics] = None,
         halloffame: Optional[deap.tools.HallOfFame] = None,
-        verbose: bool = __debug__
+        verbose: bool = __debug__,
+        cache_size: Optional[int] = None,
+        patience: Optional[int] = None,
+        target: Optional[float] = None
 ) -> Tuple[MutableSequence, deap.tools.Logbook]:
     """This algorithm reproduce the simplest evolutionary algorithm as
     presented in chapter 7 of [Back2000]_ but with elitism.
 
     Modified from [GitHubURL]_.
       - Added modified docstring from deap.algorithm.eaSimple and type annotations
+      - Added a cache of the fitness of the last evaluated genotypes
+      - Added early termination on a target fitness or on a plateau of the best fitness
 
     :param population: A list of individuals.
     :param toolbox: A :class:`~deap.base.Toolbox` that contains the evolution
@@ -32,6 +288,13 @@ def eaSimpleWithElitism(
     :param halloffame: A :class:`~deap.tools.HallOfFame` object that will
                        contain the best individuals, optional.
     :param verbose: Whether or not to log the statistics.
+    :param cache_size: The amount of genotypes whose fitness is kept to avoid
+                       evaluating them again, four times the size of the
+                       population by default.
+    :param patience: The amount of generations without improvement of the best
+                     individual after which the evolution stops, optional.
+    :param target: A fitness value of the first objective that stops the
+                   evolution once the best individual reaches it, optional.
     :returns: The final population
     :returns: A class:`~deap.tools.Logbook` with the statistics of the
               evolution
@@ -41,7 +304,8 @@ def eaSimpleWithElitism(
     :class:`~deap.tools.Logbook` with the statistics of the evolution. The
     logbook will contain the generation number, the number of evaluations for
     each generation and the statistics if a :class:`~deap.tools.Statistics` is
-    given as argument. The *cxpb* and *mutpb* arguments are passed to the
+    given as argument. Individuals whose genotype is in the cache are not
+    counted as evaluations. The *cxpb* and *mutpb* arguments are passed to the
     :func:`varAnd` function. The pseudocode goes as follow ::
 
         evaluate(population)
@@ -61,8 +325,10 @@ def eaSimpleWithElitism(
     Third, it applies the :func:`varAnd` function to produce the next
     generation population. Fourth, it evaluates the new individuals and
     compute the statistics on this population. Finally, when *ngen*
-    generations are done, the algorithm returns a tuple with the final
-    population and a :class:`~deap.tools.Logbook` of the evolution.
+    generations are done, or before if the best individual reaches *target* or
+    does not improve for *patience* generations, the algorithm returns a tuple
+    with the final population and a :class:`~deap.tools.Logbook` of the
+    evolution.
 
     .. note::
 
@@ -83,10 +349,9 @@ def eaSimpleWithElitism(
     logbook.header = ['gen', 'nevals'] + (stats.fields if stats else [])
 
     # Evaluate the individuals with an invalid fitness
-    invalid_ind = [ind for ind in population if not ind.fitness.valid]
-    fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-    for ind, fit in zip(invalid_ind, fitnesses):
-        ind.fitness.values = fit
+    cache = collections.OrderedDict()
+    cache_size = 4*len(population) if cache_size is None else cache_size
+    nevals = evaluate_invalid(population, toolbox, cache, cache_size)
 
     if halloffame is None:
         raise ValueError("halloffame parameter must not be empty!")
@@ -95,13 +360,20 @@ def eaSimpleWithElitism(
     hof_size = len(halloffame.items) if halloffame.items else 0
 
     record = stats.compile(population) if stats else {}
-    logbook.record(gen=0, nevals=len(invalid_ind), **record)
+    logbook.record(gen=0, nevals=nevals, **record)
     if verbose:
         print(logbook.stream)
 
+    best_wvalues = halloffame[0].fitness.wvalues
+    stagnation = 0
+
     # Begin the generational process
     for gen in range(1, ngen + 1):
 
+        # Stop if the best individual is already good enough
+        if target is not None and halloffame[0].fitness.values[0] == target:
+            break
+
         # Select the next generation individuals
         offspring = toolbox.select(population, len(population) - hof_size)
 
@@ -109,10 +381,7 @@ def eaSimpleWithElitism(
         offspring = deap.algorithms.varAnd(offspring, toolbox, cxpb, mutpb)
 
         # Evaluate the individuals with an invalid fitness
-        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-        for ind, fit in zip(invalid_ind, fitnesses):
-            ind.fitness.values = fit
+        nevals = evaluate_invalid(offspring, toolbox, cache, cache_size)
 
         # Add the bests back to population:
         offspring.extend(halloffame.items)
@@ -125,8 +394,17 @@ def eaSimpleWithElitism(
 
         # Append the current generation statistics to the logbook
         record = stats.compile(population) if stats else {}
-        logbook.record(gen=gen, nevals=len(invalid_ind), **record)
+        logbook.record(gen=gen, nevals=nevals, **record)
         if verbose:
             print(logbook.stream)
 
+        # Stop if the best individual did not improve for a while
+        if halloffame[0].fitness.wvalues > best_wvalues:
+            best_wvalues = halloffame[0].fitness.wvalues
+            stagnation = 0
+        else:
+            stagnation += 1
+            if patience is not None and stagnation >= patience:
+                break
+
     return population, logbook
@@ -1,11 +1,18 @@
-import multiprocessing
+import concurrent.futures
+import functools
+import math
+import os
 import time
+from multiprocessing import shared_memory, util
+from typing import Callable, List, Optional, Sequence, Tuple
 
 import deap.base
 import deap.creator
 import deap.tools
-import pandas
+import numba
+import numpy
 
+from algorithms import population_matrix
 from variant_ga_binary_simple import variant_ag_binary_simple
 from variant_ga_integer_simple import variant_ag_integer_simple
 from variant_ga_optimized import variant_ag_optimized
@@ -21,6 +28,10 @@ QUEENS_AMOUNTS = [2**i for i in range(MIN_INDEX, MAX_INDEX+1)]
 POPULATION_SIZE = 300
 GENERATION_NUMBER = 200
 
+# stop a run when a solution is found or when the best fitness does not improve for this amount of generations
+TARGET_FITNESS = 0
+PATIENCE = 25
+
 CROSSOVER_PROBABILITY = 0.9
 MUTATION_PROBABILITY = 0.1
 
@@ -30,29 +41,143 @@ VARIANTS = [variant_ag_binary_simple, variant_ag_integer_simple, variant_ag_opti
 VARIANTS_NAMES = ['Simple Bin.', 'Simple Int.', 'Optimized']
 VARIANTS_AMOUNT = len(VARIANTS)
 
+WORKERS_AMOUNT = os.cpu_count() or 1
+
+# The biggest genotype is the one of the binary variant, with one byte per bit of each queen.
+SHARED_MEMORY_SIZE = POPULATION_SIZE * MAX_QUEENS_AMOUNT * math.ceil(math.log2(MAX_QUEENS_AMOUNT))
+
+# The shared memory block with the population to evaluate, as attached by each worker process.
+worker_population: Optional[shared_memory.SharedMemory] = None
+
+
+def init_worker(name: str) -> None:
+    """Attach the worker process to the shared memory block with the population to evaluate.
+
+    The block is closed when the worker process exits. The Numba kernels of the worker use a single thread.
+
+    :param name: The name of the shared memory block
+    :type name: str
+    """
+    global worker_population
+    worker_population = shared_memory.SharedMemory(name=name)
+
+    # the worker processes do not run the atexit handlers, but they do run the finalizers with an exit priority
+    util.Finalize(worker_population, worker_population.close, exitpriority=0)
+
+    # the workers already run in parallel, so each one runs the parallel kernels in a single thread
+    numba.set_num_threads(1)
+
+
+def evaluate_rows(
+        batch_evaluate: Callable[[numpy.ndarray], List[Tuple]],
+        dtype: numpy.dtype,
+        shape: Tuple[int, int],
+        start: int,
+        stop: int
+) -> List[Tuple]:
+    """Evaluate a range of rows of the population in the shared memory block of the worker process, in a single call.
+
+    :param batch_evaluate: A function that receives a matrix with an individual in each row and returns the list of their fitnesses
+    :type batch_evaluate: Callable[[numpy.ndarray], List[Tuple]]
+    :param dtype: The type of each gene
+    :type dtype: numpy.dtype
+    :param shape: The shape of the population matrix, one row per individual
+    :type shape: Tuple[int, int]
+    :param start: The first row to evaluate
+    :type start: int
+    :param stop: The row after the last one to evaluate
+    :type stop: int
+    :return: The fitnesses of the rows
+    :rtype: List[Tuple]
+    """
+    matrix = numpy.ndarray(shape, dtype=dtype, buffer=worker_population.buf)
+    return batch_evaluate(matrix[start:stop])
+
+
+def shared_memory_map(
+        evaluate: Callable,
+        individuals: Sequence,
+        toolbox: deap.base.Toolbox,
+        executor: concurrent.futures.Executor,
+        shared_population: shared_memory.SharedMemory
+) -> List[Tuple]:
+    """Replacement of ``toolbox.map`` that evaluates the individuals in worker processes.
+
+    The individuals are copied to a shared memory block, so only the batch evaluation function and the ranges of rows to evaluate are sent to the workers. Each worker evaluates its whole range with the ``evaluateBatch`` alias of *toolbox*, so the given *evaluate* function is ignored.
+
+    :param evaluate: The evaluation function given by the algorithm. It is ignored.
+    :type evaluate: Callable
+    :param individuals: The individuals to evaluate
+    :type individuals: Sequence
+    :param toolbox: The toolbox of the running variant, with the ``evaluateBatch`` alias
+    :type toolbox: deap.base.Toolbox
+    :param executor: An executor whose workers were initialized with :func:`init_worker`
+    :type executor: concurrent.futures.Executor
+    :param shared_population: The shared memory block attached by the workers
+    :type shared_population: shared_memory.SharedMemory
+    :return: The fitnesses of the individuals, in the same order
+    :rtype: List[Tuple]
+    """
+    if not individuals:
+        return []
+
+    matrix = population_matrix(individuals)
+    if matrix.nbytes > shared_population.size:
+        raise ValueError("The population does not fit in the shared memory block!")
+    numpy.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shared_population.buf)[:] = matrix
+
+    bounds = numpy.linspace(0, len(individuals), min(WORKERS_AMOUNT, len(individuals)) + 1, dtype=int)
+    chunks = executor.map(functools.partial(evaluate_rows, toolbox.evaluateBatch, matrix.dtype, matrix.shape),
+                          bounds[:-1], bounds[1:])
+
+    return [fitness for chunk in chunks for fitness in chunk]
+
 
 def main():
 
     toolbox = deap.base.Toolbox()
 
-    # prepare to parallel execution
-    pool = multiprocessing.Pool()
-    toolbox.register("map", pool.map)
+    # prepare to parallel execution. The workers are created once and the population is shared with them.
+    shared_population = shared_memory.SharedMemory(create=True, size=SHARED_MEMORY_SIZE)
+    executor = concurrent.futures.ProcessPoolExecutor(WORKERS_AMOUNT,
+                                                      initializer=init_worker,
+                                                      initargs=(shared_population.name,))
+    toolbox.register("map", shared_memory_map, toolbox=toolbox, executor=executor,
+                     shared_population=shared_population)
 
     bests = {name: [] for name in VARIANTS_NAMES}
     times = {name: [] for name in VARIANTS_NAMES}
     logbook = {name: None for name in VARIANTS_NAMES}
 
-    for i in QUEENS_AMOUNTS:
-        for variant, name in zip(VARIANTS, VARIANTS_NAMES):
-            print(f'\nComputing {name} for {i} queens...')
-            init = time.time()
-            _, b, logbook[name] = variant(
-                i, POPULATION_SIZE, CROSSOVER_PROBABILITY,
-                MUTATION_PROBABILITY, GENERATION_NUMBER, toolbox,
-                verbose=False)
-            times[name].append(time.time() - init)
-            bests[name].append(b.fitness.values[0])
+    try:
+        for i in QUEENS_AMOUNTS:
+            for variant, name in zip(VARIANTS, VARIANTS_NAMES):
+                print(f'\nComputing {name} for {i} queens...')
+
+                # evaluate a small initial population before timing, so the workers that receive part of it compile
+                # the evaluation kernel of this size outside of the measured run. It is not guaranteed to reach every
+                # worker, and repeated genotypes are evaluated once
+                variant(i, min(WORKERS_AMOUNT, POPULATION_SIZE), CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, 0,
+                        toolbox, verbose=False)
+
+                init = time.time()
+                _, b, logbook[name] = variant(
+                    i, POPULATION_SIZE, CROSSOVER_PROBABILITY,
+                    MUTATION_PROBABILITY, GENERATION_NUMBER, toolbox,
+                    verbose=False, patience=PATIENCE, target=TARGET_FITNESS)
+                times[name].append(time.time() - init)
+                bests[name].append(b.fitness.values[0])
+    finally:
+        executor.shutdown()
+        shared_population.close()
+        shared_population.unlink()
+
+    # imported only when plotting, so the worker processes do not load them. The figures are only saved to files,
+    # so a non interactive backend is enough
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import pandas
 
     d = pandas.DataFrame(bests, index=QUEENS_AMOUNTS)
     d.to_csv('bests.csv')
@@ -60,6 +185,7 @@ def main():
                  xlabel='Queens amount',
                  ylabel='Fitness').get_figure()
     fig.savefig('bests.svg')
+    plt.close(fig)
 
     d = pandas.DataFrame(times, index=QUEENS_AMOUNTS)
     d.to_csv('times.csv')
@@ -67,6 +193,7 @@ def main():
                  xlabel='Queens amount',
                  ylabel='Execution time (s)').get_figure()
     fig.savefig('times.svg')
+    plt.close(fig)
 
     mins_means = []
     graphs_names = []
@@ -74,13 +201,15 @@ def main():
         mins_means.extend(logbook[name].select('min', 'avg'))
         graphs_names.extend((f'{name} min', f'{name} mean'))
 
-    d = pandas.DataFrame(zip(*mins_means), columns=graphs_names)
+    # the runs may stop at different generations
+    d = pandas.DataFrame({name: pandas.Series(values) for name, values in zip(graphs_names, mins_means)})
 
     d.to_csv('stats.csv')
     fig = d.plot(title=f'Min/Mean fitness per generation for {MAX_QUEENS_AMOUNT} queens',
                  xlabel='Generation number',
                  ylabel='Fitness').get_figure()
     fig.savefig('stats.svg')
+    plt.close(fig)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,17 @@
 import array
+import functools
 import math
-import random
-from typing import MutableSequence, Optional, Sequence, Tuple
+from typing import List, MutableSequence, Optional, Sequence, Tuple
 
-import deap.algorithms
 import deap.base
 import deap.creator
 import deap.tools
 import numpy
 
+from algorithms import (FitnessStatistics, batch_map, create_lines_count, eaSimpleWithElitism,
+                        get_violations_batch_kernel, get_violations_kernel, population_from_matrix,
+                        population_matrix, random_generator)
+
 # The definition of the Individual class must be set in module level in order multiprocessing to work.
 
 # define a single objective, minimizing fitness strategy:
@@ -22,43 +25,47 @@ deap.creator.create("Individual",
                     fitness=deap.creator.FitnessMin)
 
 
-def get_value(ind: Sequence, pos: int, queens_amount: int, bits_amount: int) -> int:
-    """Gets the value in base 10 of the given position in the given individual
+@functools.lru_cache()
+def get_partial_powers(bits_amount: int) -> numpy.ndarray:
+    """Gets the matrix that computes the partial sums of the bits of a value, starting from the less significative bit.
+
+    The e-th column has the e-th power of two in its first e+1 rows, so multiplying a vector of bits by this matrix gives all the partial sums at once.
 
-    :param ind: An individual
-    :type ind: deap.creator.SimpleIndividual
-    :param pos: The position of a row in the board
-    :type pos: int
-    :param queens_amount: The amount of queens in the board
-    :type queens_amount: int
     :param bits_amount: The amount of bits that it is used to represent a column value
     :type bits_amount: int
-    :return: The value of the column in the given row in base 10
-    :rtype: int
+    :return: An upper triangular matrix of powers of two
+    :rtype: numpy.ndarray
     """
-    v = 0
+    powers = 2**numpy.arange(bits_amount, dtype=numpy.int64)
+    return numpy.triu(numpy.repeat(powers[:, None], bits_amount, axis=1))
 
-    # the position of the less significative bit of the value in pos.
-    k = pos*bits_amount
 
-    # the exponent of each summand in the representation
-    e = 0
+def decode(bits: numpy.ndarray, queens_amount: int, bits_amount: int) -> numpy.ndarray:
+    """Gets the values in base 10 of all the positions of one or several individuals
 
-    while e < bits_amount and v < queens_amount:
-        v += ind[k+e]*2**e
-        e += 1
+    A value is read from its less significative bit, and the reading stops before the first bit that would take it out of range.
 
-    # undo one step if the value is out of range
-    if v >= queens_amount:
-        v -= ind[k+e-1]*2**(e-1)
+    :param bits: The bits of an individual, or a matrix with the bits of an individual in each row
+    :type bits: numpy.ndarray
+    :param queens_amount: The amount of queens in the board
+    :type queens_amount: int
+    :param bits_amount: The amount of bits that it is used to represent a column value
+    :type bits_amount: int
+    :return: The column of each row, with the same leading dimensions as *bits*
+    :rtype: numpy.ndarray
+    """
+    bits = bits.reshape(bits.shape[:-1] + (queens_amount, bits_amount))
+    partial_values = bits @ get_partial_powers(bits_amount)
 
-    return v
+    # the partial values only grow, so the value is the biggest one that is still in range
+    return numpy.where(partial_values < queens_amount, partial_values, 0).max(axis=-1)
 
 
 def get_violations_count(
         ind: Sequence,
         queens_amount: int,
-        bits_amount: int
+        bits_amount: int,
+        lines_count: Optional[numpy.ndarray] = None
 ) -> Tuple[int]:
     """Get the amount of violations.
 
@@ -70,18 +77,62 @@ def get_violations_count(
     :type queens_amount: int
     :param bits_amount: The amount of bits that it is used to represent a column value
     :type bits_amount: int
+    :param lines_count: A buffer created by :func:`~algorithms.create_lines_count` to reuse between calls. It is allocated if not given.
+    :type lines_count: Optional[numpy.ndarray]
     :return: The amount of violations as a one element tuple
     :rtype: Tuple[int]
     """
-    violations_amount = 0
-    for i in range(queens_amount):
-        for j in range(i+1, queens_amount):
-            vi = get_value(ind, i, queens_amount, bits_amount)
-            vj = get_value(ind, j, queens_amount, bits_amount)
-            if vi == vj or abs(i-j) == abs(vi-vj):
-                violations_amount += 1
+    if lines_count is None:
+        lines_count = create_lines_count(queens_amount)
+
+    columns = decode(numpy.asarray(ind), queens_amount, bits_amount)
+
+    count_violations = get_violations_kernel(queens_amount, 'int64', True)
 
-    return violations_amount,
+    return count_violations(columns, lines_count),
+
+
+def get_violations_counts(
+        individuals: Sequence,
+        queens_amount: int,
+        bits_amount: int
+) -> List[Tuple[int]]:
+    """Get the amount of violations of several individuals at once.
+
+    A violation is counted if two queens are placed in the same column or are in the same diagonal.
+
+    :param individuals: The individuals, or a matrix with one in each row
+    :type individuals: Sequence[deap.creator.SimpleIndividual]
+    :param queens_amount: The amount of queens
+    :type queens_amount: int
+    :param bits_amount: The amount of bits that it is used to represent a column value
+    :type bits_amount: int
+    :return: The amount of violations of each individual as one element tuples
+    :rtype: List[Tuple[int]]
+    """
+    lines_count = create_lines_count(queens_amount, individuals_amount=len(individuals))
+    columns = decode(population_matrix(individuals), queens_amount, bits_amount)
+    count_violations_batch = get_violations_batch_kernel(queens_amount, 'int64', True)
+    violations_amounts = count_violations_batch(columns, lines_count)
+
+    return [(int(v),) for v in violations_amounts]
+
+
+def create_population(n: int, queens_amount: int, bits_amount: int) -> List:
+    """Create individuals with random bits. The bits of all the individuals are generated at once.
+
+    :param n: The amount of individuals
+    :type n: int
+    :param queens_amount: The amount of queens
+    :type queens_amount: int
+    :param bits_amount: The amount of bits that it is used to represent a column value
+    :type bits_amount: int
+    :return: The individuals
+    :rtype: List[deap.creator.SimpleIndividual]
+    """
+    bits = random_generator().integers(2, size=(n, queens_amount*bits_amount))
+
+    return population_from_matrix(deap.creator.Individual, bits)
 
 
 def variant_ag_binary_simple(
@@ -91,11 +142,13 @@ def variant_ag_binary_simple(
         mutpb: float,
         ngen: int,
         toolbox: Optional[deap.base.Toolbox] = None,
-        verbose: bool = __debug__
+        verbose: bool = __debug__,
+        patience: Optional[int] = None,
+        target: Optional[float] = None
 ) -> Tuple[MutableSequence, Sequence, deap.tools.Logbook]:
     """This is the implementation of a simple variant solution to the N-Queens using Genetic Algorithm.
 
-    The genotype is an array of integers, where repetition is allowed. Each i-th value in the array specify the column of the i-th row where a queen is positioned. Roulette selection, one-point crossover and uniform integer mutation are used. The objective is to minimice the amount of violations (mutual-attacking queens) in the board.
+    The genotype is an array of integers, where repetition is allowed. Each i-th value in the array specify the column of the i-th row where a queen is positioned. Roulette selection, one-point crossover and uniform integer mutation are used, and the best individual is kept between generations. The objective is to minimice the amount of violations (mutual-attacking queens) in the board.
 
     :param queens_amount: The size of the board and also the amount of queens. The board will always be considered an square matrix.
     :type queens_amount: int
@@ -107,48 +160,58 @@ def variant_ag_binary_simple(
     :type mutpb: float
     :param ngen: Amount of generations
     :type ngen: int
-    :param toolbox: A toolbox with already defined functions. This is useful, for example, in case a different function ``map`` is needed.
+    :param toolbox: A toolbox with already defined functions. This is useful, for example, in case a different function ``map`` is needed. If not given, the whole population is evaluated in a single vectorized call. An ``evaluateBatch`` alias is registered in it in any case, so its ``map`` can evaluate several individuals at once.
     :type toolbox: Optional[deap.base.Toolbox]
     :param verbose: Whether to give extra console output or not
     :type verbose: bool
+    :param patience: The amount of generations without improvement of the best individual after which the evolution stops
+    :type patience: Optional[int]
+    :param target: A fitness value that stops the evolution once the best individual reaches it
+    :type target: Optional[float]
     :return: The final population, the best individual found and a class:`~deap.tools.Logbook` with the statistics of the evolution
     :rtype: Tuple[MutableSequence, Sequence, deap.tools.Logbook]
     """
 
+    batch_evaluation = toolbox is None
     toolbox = toolbox or deap.base.Toolbox()
 
-    # create an operator that randomly returns 0 or 1:
-    toolbox.register("zeroOrOne", random.randint, 0, 1)
-
     bits_amount = math.ceil(math.log2(queens_amount))
 
-    # create the individual operator to fill up an Individual instance:
-    toolbox.register("individualCreator", deap.tools.initRepeat,
-                     deap.creator.Individual, toolbox.zeroOrOne, bits_amount*queens_amount)
-
-    # create the population operator to generate a list of individuals:
-    toolbox.register("populationCreator", deap.tools.initRepeat, list, toolbox.individualCreator)
+    # create the population operator to generate a list of individuals with random bits:
+    toolbox.register("populationCreator", create_population,
+                     queens_amount=queens_amount,
+                     bits_amount=bits_amount)
 
     toolbox.register('evaluate', get_violations_count,
+                     queens_amount=queens_amount,
+                     bits_amount=bits_amount,
+                     lines_count=create_lines_count(queens_amount))
+
+    # evaluate several individuals in a single vectorized call, the whole population if no toolbox is given:
+    toolbox.register("evaluateBatch", get_violations_counts,
                      queens_amount=queens_amount,
                      bits_amount=bits_amount)
-    toolbox.register("select", deap.tools.selTournament, tournsize=2)
+    if batch_evaluation:
+        toolbox.register("map", batch_map, batch_evaluate=toolbox.evaluateBatch)
+
+    toolbox.register("select", deap.tools.selTournament, tournsize=3)
     toolbox.register("mate", deap.tools.cxOnePoint)
     toolbox.register("mutate", deap.tools.mutFlipBit, indpb=1.0/queens_amount)
 
     population = toolbox.populationCreator(n=population_size)
 
     # prepare the statistics object:
-    stats = deap.tools.Statistics(lambda ind: ind.fitness.values)
+    stats = FitnessStatistics()
     stats.register("min", numpy.min)
     stats.register("avg", numpy.mean)
 
     # define the hall-of-fame object:
     hof = deap.tools.HallOfFame(1)
 
-    # perform the Genetic Algorithm flow:
-    population, logbook = deap.algorithms.eaSimple(
+    # perform the Genetic Algorithm flow, keeping the best individual between generations:
+    population, logbook = eaSimpleWithElitism(
         population, toolbox, cxpb=cxpb, mutpb=mutpb,
-        ngen=ngen, stats=stats, halloffame=hof, verbose=verbose)
+        ngen=ngen, stats=stats, halloffame=hof, verbose=verbose,
+        patience=patience, target=target)
 
     return population, hof.items[0], logbook
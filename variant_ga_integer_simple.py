@@ -1,13 +1,15 @@
 import array
-import random
-from typing import MutableSequence, Optional, Sequence, Tuple
+from typing import List, MutableSequence, Optional, Sequence, Tuple
 
-import deap.algorithms
 import deap.base
 import deap.creator
 import deap.tools
 import numpy
 
+from algorithms import (FitnessStatistics, batch_map, create_lines_count, eaSimpleWithElitism,
+                        get_violations_batch_kernel, get_violations_kernel, population_from_matrix,
+                        population_matrix, random_generator)
+
 # The definition of the Individual class must be set in module level in order multiprocessing to work.
 
 # define a single objective, minimizing fitness strategy:
@@ -21,24 +23,63 @@ deap.creator.create("Individual",
                     fitness=deap.creator.FitnessMin)
 
 
-def get_violations_count(individual: Sequence, queens_amount: int) -> Tuple[int]:
+def get_violations_count(
+        individual: Sequence,
+        queens_amount: int,
+        lines_count: Optional[numpy.ndarray] = None
+) -> Tuple[int]:
     """Get the amount of violations.
     A violation is counted if two queens are placed in the same column or are in the same diagonal.
 
     Args:
         individual (deap.creator.SimpleIndividual): An individual
         queens_amount (int): The amount of queens
+        lines_count (Optional[numpy.ndarray]): A buffer created by :func:`~algorithms.create_lines_count` to reuse
+            between calls. It is allocated if not given.
 
     Returns:
         int: the amount of violations
     """
-    violations_amount = 0
-    for i in range(queens_amount):
-        for j in range(i+1, queens_amount):
-            if individual[i] == individual[j] or abs(i-j) == abs(individual[i]-individual[j]):
-                violations_amount += 1
+    if lines_count is None:
+        lines_count = create_lines_count(queens_amount)
+
+    count_violations = get_violations_kernel(queens_amount, 'uint8', True)
+
+    return count_violations(numpy.ascontiguousarray(individual, dtype=numpy.uint8), lines_count),
+
+
+def get_violations_counts(individuals: Sequence, queens_amount: int) -> List[Tuple[int]]:
+    """Get the amount of violations of several individuals at once.
+    A violation is counted if two queens are placed in the same column or are in the same diagonal.
+
+    Args:
+        individuals (Sequence[deap.creator.Individual]): The individuals, or a matrix with one in each row
+        queens_amount (int): The amount of queens
 
-    return violations_amount,
+    Returns:
+        List[Tuple[int]]: the amount of violations of each individual
+    """
+    lines_count = create_lines_count(queens_amount, individuals_amount=len(individuals))
+    count_violations_batch = get_violations_batch_kernel(queens_amount, 'uint8', True)
+    violations_amounts = count_violations_batch(population_matrix(individuals), lines_count)
+
+    return [(int(v),) for v in violations_amounts]
+
+
+def create_population(n: int, queens_amount: int) -> List:
+    """Create individuals with random indices.
+    The indices of all the individuals are generated at once.
+
+    Args:
+        n (int): The amount of individuals
+        queens_amount (int): The amount of queens
+
+    Returns:
+        List[deap.creator.Individual]: the individuals
+    """
+    indices = random_generator().integers(queens_amount, size=(n, queens_amount))
+
+    return population_from_matrix(deap.creator.Individual, indices)
 
 
 def variant_ag_integer_simple(
@@ -48,13 +89,15 @@ def variant_ag_integer_simple(
         mutpb: float,
         ngen: int,
         toolbox: Optional[deap.base.Toolbox] = None,
-        verbose: bool = __debug__
+        verbose: bool = __debug__,
+        patience: Optional[int] = None,
+        target: Optional[float] = None
 ) -> Tuple[MutableSequence, Sequence, deap.tools.Logbook]:
     """This is the implementation of a simple variant solution to the N-Queens using Genetic Algorithm.
 
-    The genotype is an array of integers, where repetition is allowed. Each i-th value in the array specify the column of the i-th row where a queen is positioned. Tournament selection, one-point crossover and uniform integer mutation are used. The objective is to minimice the amount of violations (mutual-attacking queens) in the board.
+    The genotype is an array of integers, where repetition is allowed. Each i-th value in the array specify the column of the i-th row where a queen is positioned. Tournament selection, one-point crossover and uniform integer mutation are used, and the best individual is kept between generations. The objective is to minimice the amount of violations (mutual-attacking queens) in the board.
 
-    :param queens_amount: The size of the board and also the amount of queens. The board will always be considered an square matrix.
+    :param queens_amount: The size of the board and also the amount of queens. The board will always be considered an square matrix. It can not be greater than 256, since each column is stored in a single byte.
     :type queens_amount: int
     :param population_size: The size of the population
     :type population_size: int
@@ -64,28 +107,36 @@ def variant_ag_integer_simple(
     :type mutpb: float
     :param ngen: Amount of generations
     :type ngen: int
-    :param toolbox: A toolbox with already defined functions. This is useful, for example, in case a different function ``map`` is needed.
+    :param toolbox: A toolbox with already defined functions. This is useful, for example, in case a different function ``map`` is needed. If not given, the whole population is evaluated in a single vectorized call. An ``evaluateBatch`` alias is registered in it in any case, so its ``map`` can evaluate several individuals at once.
     :type toolbox: Optional[deap.base.Toolbox]
     :param verbose: Whether to give extra console output or not
     :type verbose: bool
+    :param patience: The amount of generations without improvement of the best individual after which the evolution stops
+    :type patience: Optional[int]
+    :param target: A fitness value that stops the evolution once the best individual reaches it
+    :type target: Optional[float]
     :return: The final population, the best individual found and a class:`~deap.tools.Logbook` with the statistics of the evolution
     :rtype: Tuple[MutableSequence, Sequence, deap.tools.Logbook]
     """
 
+    if queens_amount > 256:
+        raise ValueError("queens_amount must not be greater than 256!")
+
+    batch_evaluation = toolbox is None
     toolbox = toolbox or deap.base.Toolbox()
 
-    # create an operator that generates randomly shuffled indices:
-    toolbox.register("randomValues", random.choices, range(queens_amount), k=queens_amount)
+    # create the population operator to generate a list of individuals with random indices:
+    toolbox.register("populationCreator", create_population, queens_amount=queens_amount)
 
-    # create the individual creation operator to fill up an Individual instance with indices:
-    toolbox.register("individualCreator", deap.tools.initIterate,
-                     deap.creator.Individual, toolbox.randomValues)
+    toolbox.register('evaluate', get_violations_count, queens_amount=queens_amount,
+                     lines_count=create_lines_count(queens_amount))
 
-    # create the population operator to generate a list of individuals:
-    toolbox.register("populationCreator", deap.tools.initRepeat, list, toolbox.individualCreator)
+    # evaluate several individuals in a single vectorized call, the whole population if no toolbox is given:
+    toolbox.register("evaluateBatch", get_violations_counts, queens_amount=queens_amount)
+    if batch_evaluation:
+        toolbox.register("map", batch_map, batch_evaluate=toolbox.evaluateBatch)
 
-    toolbox.register('evaluate', get_violations_count, queens_amount=queens_amount)
-    toolbox.register("select", deap.tools.selTournament, tournsize=2)
+    toolbox.register("select", deap.tools.selTournament, tournsize=3)
     toolbox.register("mate", deap.tools.cxOnePoint)
     toolbox.register("mutate", deap.tools.mutUniformInt, low=0,
                      up=queens_amount-1, indpb=1.0/queens_amount)
@@ -93,16 +144,17 @@ def variant_ag_integer_simple(
     population = toolbox.populationCreator(n=population_size)
 
     # prepare the statistics object:
-    stats = deap.tools.Statistics(lambda ind: ind.fitness.values)
+    stats = FitnessStatistics()
     stats.register("min", numpy.min)
     stats.register("avg", numpy.mean)
 
     # define the hall-of-fame object:
     hof = deap.tools.HallOfFame(1)
 
-    # perform the Genetic Algorithm flow:
-    population, logbook = deap.algorithms.eaSimple(
+    # perform the Genetic Algorithm flow, keeping the best individual between generations:
+    population, logbook = eaSimpleWithElitism(
         population, toolbox, cxpb=cxpb, mutpb=mutpb,
-        ngen=ngen, stats=stats, halloffame=hof, verbose=verbose)
+        ngen=ngen, stats=stats, halloffame=hof, verbose=verbose,
+        patience=patience, target=target)
 
     return population, hof.items[0], logbook
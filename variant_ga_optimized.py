@@ -1,13 +1,14 @@
 import array
-import random
-from typing import MutableSequence, Optional, Sequence, Tuple
+from typing import List, MutableSequence, Optional, Sequence, Tuple
 
 import deap.base
 import deap.creator
 import deap.tools
 import numpy
 
-from algorithms import eaSimpleWithElitism
+from algorithms import (FitnessStatistics, batch_map, create_lines_count, eaSimpleWithElitism,
+                        get_violations_batch_kernel, get_violations_kernel, population_from_matrix,
+                        population_matrix, random_generator)
 
 # The definition of the Individual class must be set in module level in order multiprocessing to work.
 
@@ -22,31 +23,63 @@ deap.creator.create("Individual",
                     fitness=deap.creator.FitnessMin)
 
 
-# create the Individual class based on list of integers:
-deap.creator.create("OptimizedIndividual",
-                    array.array,
-                    typecode='i',
-                    fitness=deap.creator.FitnessMin)
-
-
-def get_violations_count(individual: Sequence, queens_amount: int) -> Tuple[int]:
+def get_violations_count(
+        individual: Sequence,
+        queens_amount: int,
+        lines_count: Optional[numpy.ndarray] = None
+) -> Tuple[int]:
     """Get the amount of violations.
     A violation is counted if two queens are placed in the same diagonal.
 
     Args:
         individual (deap.creator.Individual): An individual
         queens_amount (int): The amount of queens
+        lines_count (Optional[numpy.ndarray]): A buffer created by :func:`~algorithms.create_lines_count` to reuse
+            between calls. It is allocated if not given.
 
     Returns:
         int: the amount of violations
     """
-    violations_amount = 0
-    for i in range(queens_amount):
-        for j in range(i+1, queens_amount):
-            if abs(i-j) == abs(individual[i]-individual[j]):
-                violations_amount += 1
+    if lines_count is None:
+        lines_count = create_lines_count(queens_amount, count_columns=False)
+
+    count_violations = get_violations_kernel(queens_amount, 'uint8', False)
+
+    return count_violations(numpy.ascontiguousarray(individual, dtype=numpy.uint8), lines_count),
+
+
+def get_violations_counts(individuals: Sequence, queens_amount: int) -> List[Tuple[int]]:
+    """Get the amount of violations of several individuals at once.
+    A violation is counted if two queens are placed in the same diagonal.
+
+    Args:
+        individuals (Sequence[deap.creator.Individual]): The individuals, or a matrix with one in each row
+        queens_amount (int): The amount of queens
+
+    Returns:
+        List[Tuple[int]]: the amount of violations of each individual
+    """
+    lines_count = create_lines_count(queens_amount, count_columns=False, individuals_amount=len(individuals))
+    count_violations_batch = get_violations_batch_kernel(queens_amount, 'uint8', False)
+    violations_amounts = count_violations_batch(population_matrix(individuals), lines_count)
+
+    return [(int(v),) for v in violations_amounts]
+
 
-    return violations_amount,
+def create_population(n: int, queens_amount: int) -> List:
+    """Create individuals with randomly shuffled indices.
+    The permutations of all the individuals are generated at once, by sorting random keys.
+
+    Args:
+        n (int): The amount of individuals
+        queens_amount (int): The amount of queens
+
+    Returns:
+        List[deap.creator.Individual]: the individuals
+    """
+    shuffled_indices = numpy.argsort(random_generator().random((n, queens_amount)), axis=1)
+
+    return population_from_matrix(deap.creator.Individual, shuffled_indices)
 
 
 def variant_ag_optimized(
@@ -56,7 +89,9 @@ def variant_ag_optimized(
         mutpb: float,
         ngen: int,
         toolbox: Optional[deap.base.Toolbox] = None,
-    verbose: bool = __debug__
+        verbose: bool = __debug__,
+        patience: Optional[int] = None,
+        target: Optional[float] = None
 ) -> Tuple[MutableSequence, Sequence, deap.tools.Logbook]:
     """This is the implementation of a variant solution to the N-Queens using Genetic Algorithm as proposed in [Wirsansky]_.
 
@@ -68,7 +103,7 @@ def variant_ag_optimized(
 
     .. [SolURL] https://github.com/PacktPublishing/Hands-On-Genetic-Algorithms-with-Python/blob/master/Chapter05/01-solve-n-queens.py
 
-    :param queens_amount: The size of the board and also the amount of queens. The board will always be considered an square matrix.
+    :param queens_amount: The size of the board and also the amount of queens. The board will always be considered an square matrix. It can not be greater than 256, since each column is stored in a single byte.
     :type queens_amount: int
     :param population_size: The size of the population
     :type population_size: int
@@ -78,31 +113,38 @@ def variant_ag_optimized(
     :type mutpb: float
     :param ngen: Amount of generations
     :type ngen: int
-    :param toolbox: A toolbox with already defined functions. This is useful, for example, in case a different function ``map`` is needed.
+    :param toolbox: A toolbox with already defined functions. This is useful, for example, in case a different function ``map`` is needed. If not given, the whole population is evaluated in a single vectorized call. An ``evaluateBatch`` alias is registered in it in any case, so its ``map`` can evaluate several individuals at once.
     :type toolbox: Optional[deap.base.Toolbox]
     :param verbose: Whether to give extra console output or not
     :type verbose: bool
+    :param patience: The amount of generations without improvement of the best individual after which the evolution stops
+    :type patience: Optional[int]
+    :param target: A fitness value that stops the evolution once the best individual reaches it
+    :type target: Optional[float]
     :return: The final population, the best individual found and a class:`~deap.tools.Logbook` with the statistics of the evolution
     :rtype: Tuple[MutableSequence, Sequence, deap.tools.Logbook]
     """
 
-    toolbox = toolbox or deap.base.Toolbox()
+    if queens_amount > 256:
+        raise ValueError("queens_amount must not be greater than 256!")
 
-    # create an operator that generates randomly shuffled indices:
-    toolbox.register("randomOrder", random.sample, range(queens_amount), queens_amount)
-
-    # create the individual creation operator to fill up an Individual instance with shuffled indices:
-    toolbox.register("individualCreator", deap.tools.initIterate,
-                     deap.creator.Individual, toolbox.randomOrder)
+    batch_evaluation = toolbox is None
+    toolbox = toolbox or deap.base.Toolbox()
 
-    # create the population creation operator to generate a list of individuals:
-    toolbox.register("populationCreator", deap.tools.initRepeat, list, toolbox.individualCreator)
+    # create the population creation operator to generate a list of individuals with shuffled indices:
+    toolbox.register("populationCreator", create_population, queens_amount=queens_amount)
 
     # fitness calculation - compute the total distance of the list of cities represented by indices:
-    toolbox.register("evaluate", get_violations_count, queens_amount=queens_amount)
+    toolbox.register("evaluate", get_violations_count, queens_amount=queens_amount,
+                     lines_count=create_lines_count(queens_amount, count_columns=False))
+
+    # evaluate several individuals in a single vectorized call, the whole population if no toolbox is given:
+    toolbox.register("evaluateBatch", get_violations_counts, queens_amount=queens_amount)
+    if batch_evaluation:
+        toolbox.register("map", batch_map, batch_evaluate=toolbox.evaluateBatch)
 
     # Genetic operators:
-    toolbox.register("select", deap.tools.selTournament, tournsize=2)
+    toolbox.register("select", deap.tools.selTournament, tournsize=3)
     toolbox.register("mate", deap.tools.cxUniformPartialyMatched, indpb=2.0/queens_amount)
     toolbox.register("mutate", deap.tools.mutShuffleIndexes, indpb=1.0/queens_amount)
 
@@ -110,7 +152,7 @@ def variant_ag_optimized(
     population = toolbox.populationCreator(n=population_size)
 
     # prepare the statistics object:
-    stats = deap.tools.Statistics(lambda ind: ind.fitness.values)
+    stats = FitnessStatistics()
     stats.register("min", numpy.min)
     stats.register("avg", numpy.mean)
 
@@ -119,6 +161,7 @@ def variant_ag_optimized(
 
     population, logbook = eaSimpleWithElitism(
         population, toolbox, cxpb=cxpb, mutpb=mutpb,
-        ngen=ngen, stats=stats, halloffame=hof, verbose=verbose)
+        ngen=ngen, stats=stats, halloffame=hof, verbose=verbose,
+        patience=patience, target=target)
 
     return population, hof.items[0], logbook